@@ -1,43 +1,274 @@
 #!/usr/bin/env python
 
 import copy
+import hmac
+import os
+import threading
+from argparse import ArgumentParser
 from cStringIO import StringIO
-from flask import Flask, send_file
+from datetime import datetime, timedelta
+from flask import Flask, Response, abort, jsonify, redirect, request, send_file
 from lib.LossyAudioEncoder import MP3Encoder, OggEncoder
-from lib.wavfile import WavFile
-from utils import AudioServerRequest, MP3Settings, OggSettings, WaveformSettings, WaveformGenerator
+from utils import AudioServerRequest, MP3Settings, OggSettings, WaveformSettings, InfoSettings, EncoderPool, AudioProbe
+from utils import ArtefactCache, HashRing, parseNodes, Scheduler
 
 class Config(object):
 	DEBUG = True
+	ENCODER_POOL_SIZE = 2
+	ENCODER_POOL_MAX_JOBS = 200
+	CACHE_MAX_AGE = 365 * 24 * 60 * 60 # seconds - recordings don't change once written
+	FILE_CHUNK_SIZE = 256 * 1024 # bytes read per offloaded call when streaming cached artefacts
+	PROBE_CACHE_SIZE = 4096
+	PROBE_DATABASE = os.environ.get("AUDIO_SERVER_PROBE_DATABASE") # optional sqlite path
+	CACHE_DIR = os.environ.get("AUDIO_SERVER_CACHE_DIR") # artefact cache, disabled if not set
+	CACHE_MAX_BYTES = int(os.environ.get("AUDIO_SERVER_CACHE_MAX_BYTES", 10 * 1024 ** 3)) # least recently used evicted beyond this
+	CACHE_NODES = parseNodes(os.environ.get("AUDIO_SERVER_NODES", "")) # name -> base URL
+	CACHE_REPLICAS = 2
+	NODE_NAME = os.environ.get("AUDIO_SERVER_NODE") # this server's name in CACHE_NODES
+	CACHE_CHECK_TIMEOUT = 0.5 # seconds - replicas checking an artefact with the source's server
+	ENCODER_BULK_LIMIT = 1 # below ENCODER_POOL_SIZE so interactive encodes always find a free worker
+	SCHEDULER_SLOTS = 4 # waveform jobs
+	SCHEDULER_BULK_LIMIT = 2
+	SCHEDULER_BULK_PER_CLIENT = 1
+	SCHEDULER_INTERACTIVE_SLO = 1.0 # seconds
+
+# types whose output is cached, and their settings
+CACHED_TYPES = {
+	"mp3" : MP3Settings,
+	"ogg" : OggSettings,
+	"waveform" : WaveformSettings,
+}
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
+# warm encoder workers, started by startEncoders()
+mp3Encoder = EncoderPool(MP3Encoder, size=app.config["ENCODER_POOL_SIZE"], maxJobs=app.config["ENCODER_POOL_MAX_JOBS"])
+oggEncoder = EncoderPool(OggEncoder, size=app.config["ENCODER_POOL_SIZE"], maxJobs=app.config["ENCODER_POOL_MAX_JOBS"])
+
+# cached header metadata
+audioProbe = AudioProbe(app.config["PROBE_CACHE_SIZE"], app.config["PROBE_DATABASE"])
+
+# derived artefacts, placed on CACHE_REPLICAS nodes
+artefactCache = ArtefactCache(app.config["CACHE_DIR"], app.config["CACHE_MAX_BYTES"]) if app.config["CACHE_DIR"] else None
+ring = HashRing(app.config["CACHE_NODES"].keys())
+
+# interactive requests run ahead of bulk ones. Each encoder pool has
+# its own scheduler with a slot per worker, so waits for a worker are
+# seen by the scheduler and bulk jobs can't hold every worker
+schedulers = {
+	"mp3" : Scheduler(
+		slots=app.config["ENCODER_POOL_SIZE"],
+		bulkLimit=app.config["ENCODER_BULK_LIMIT"],
+		bulkPerClient=app.config["SCHEDULER_BULK_PER_CLIENT"],
+		interactiveSLO=app.config["SCHEDULER_INTERACTIVE_SLO"],
+	),
+	"ogg" : Scheduler(
+		slots=app.config["ENCODER_POOL_SIZE"],
+		bulkLimit=app.config["ENCODER_BULK_LIMIT"],
+		bulkPerClient=app.config["SCHEDULER_BULK_PER_CLIENT"],
+		interactiveSLO=app.config["SCHEDULER_INTERACTIVE_SLO"],
+	),
+	"waveform" : Scheduler(
+		slots=app.config["SCHEDULER_SLOTS"],
+		bulkLimit=app.config["SCHEDULER_BULK_LIMIT"],
+		bulkPerClient=app.config["SCHEDULER_BULK_PER_CLIENT"],
+		interactiveSLO=app.config["SCHEDULER_INTERACTIVE_SLO"],
+	),
+}
+
+
+def warmUp():
+	"""
+	Imports the modules which are otherwise loaded on
+	first use. Call in the master process before forking
+	workers (e.g. from a pre-fork server hook) so that
+	they share the imports copy-on-write.
+	"""
+	import lib.wavfile
+	import utils
+	utils.preload()
+
+
+def startEncoders():
+	"""
+	Starts the encoder workers so that the first
+	requests don't wait for them. Call in each serving
+	process - under a pre-forking server, from a
+	post-fork hook rather than warmUp().
+	"""
+	mp3Encoder.start()
+	oggEncoder.start()
+
+
+def offload(func, *args, **kwArgs):
+	"""
+	Runs blocking or CPU-bound work for a request.
+	Runs inline by default; async_server.py replaces
+	this to push the work onto a thread pool.
+	"""
+	return func(*args, **kwArgs)
+
+
+def sendFile(fp, mimetype):
+	"""
+	Streams an open file, reading each chunk through
+	offload() so that disk reads don't block the async
+	server's event loop. The file is closed once sent.
+	"""
+	def chunks():
+		try:
+			while True:
+				chunk = offload(fp.read, app.config["FILE_CHUNK_SIZE"])
+				if not chunk:
+					break
+				yield chunk
+		finally:
+			fp.close()
+
+	response = Response(chunks(), mimetype=mimetype, direct_passthrough=True)
+	response.content_length = os.fstat(fp.fileno()).st_size
+	return response
+
+
+def isNotModified(etag, lastModified):
+	"""
+	Checks the request's conditional headers against
+	the validators. If-Modified-Since is only used when
+	no If-None-Match is provided.
+	"""
+	if request.if_none_match:
+		return request.if_none_match.contains(etag)
+
+	if request.if_modified_since is not None:
+		since = request.if_modified_since.replace(tzinfo=None)
+		return datetime.utcfromtimestamp(lastModified) <= since
+
+	return False
+
+
+def replicate(key, meta, data):
+	"""
+	Pushes an artefact to the other nodes responsible
+	for it. Failures are ignored - the artefact can
+	always be regenerated.
+	"""
+	for node in ring.nodes(key, app.config["CACHE_REPLICAS"]):
+		if node == app.config["NODE_NAME"]:
+			continue
+		try:
+			ArtefactCache.push(app.config["CACHE_NODES"][node], key, meta, data, AudioServerRequest.SECRET_KEY)
+		except Exception:
+			app.logger.warning("Failed to replicate artefact %s to %s", key, node, exc_info=True)
+
+
+def sourceNode(req):
+	"""
+	Returns the name of the other server hosting the
+	request's audio, or None if it isn't known.
+	"""
+	parts = req.filePath.split("/")
+	node = parts[1] if len(parts) > 1 else None
+	if node not in app.config["CACHE_NODES"] or node == app.config["NODE_NAME"]:
+		return None
+	return node
+
+
+def sendCached(req, type, settingValidator, mimetype, func, *args, **kwArgs):
+	"""
+	Serves the artefact from the cache if present,
+	otherwise runs func to produce it. Conditional
+	requests are answered with a 304 without touching
+	the audio. Either way the response carries
+	validators and long-lived cache headers.
+
+	Cached artefacts are only served if the source
+	hasn't changed since. Replicas without the audio
+	check with the server hosting it, and redirect
+	there if their copy is stale. If it can't be
+	reached the copy is served but not as immutable.
+	"""
+	key = req.cacheKey(type, settingValidator)
+	cached = offload(artefactCache.get, key) if artefactCache is not None else None
+	verified = True
+
+	if cached is not None and os.path.isfile(req.filePath):
+		# the source is local - make sure it hasn't changed
+		etag, lastModified = req.validator(type, settingValidator)
+		if etag != cached[1]["etag"]:
+			cached[0].close()
+			cached = None
+
+	elif cached is not None:
+		source = sourceNode(req)
+		etag = None
+		if source is not None:
+			etag = ArtefactCache.currentETag(app.config["CACHE_NODES"][source], type, req.encoded, app.config["CACHE_CHECK_TIMEOUT"])
+
+		if etag is None:
+			verified = False
+		elif etag != cached[1]["etag"]:
+			cached[0].close()
+			offload(artefactCache.remove, key)
+			return redirect(req.buildURL(app.config["CACHE_NODES"][source], type))
+
+	if cached is not None:
+		fp, meta = cached
+		etag, lastModified = meta["etag"], meta["lastModified"]
+	else:
+		req.validate(settingValidator)
+		etag, lastModified = req.validator(type, settingValidator)
+		fp = None
+
+	if isNotModified(etag, lastModified):
+		if fp is not None:
+			fp.close()
+		response = Response(status=304)
+	elif fp is not None:
+		response = sendFile(fp, mimetype)
+	else:
+		client = req.client or request.remote_addr
+		# admitted before offloading so queued jobs don't hold pool threads
+		with schedulers[type].slot(req.priority, client):
+			data = offload(func, *args, **kwArgs)
+		if artefactCache is not None:
+			meta = dict(etag=etag, lastModified=lastModified, mimetype=mimetype)
+			offload(artefactCache.put, key, data, meta)
+			thread = threading.Thread(target=replicate, args=(key, meta, data))
+			thread.daemon = True
+			thread.start()
+		response = send_file(StringIO(data), mimetype=mimetype)
+
+	maxAge = app.config["CACHE_MAX_AGE"]
+	response.set_etag(etag)
+	response.last_modified = datetime.utcfromtimestamp(lastModified)
+	if verified:
+		response.expires = datetime.utcnow() + timedelta(seconds=maxAge)
+		response.headers["Cache-Control"] = "public, max-age=%d, immutable" %maxAge
+	else:
+		# unchecked replica - have clients revalidate
+		response.headers["Cache-Control"] = "public, no-cache"
+	return response
+
 
 @app.route("/api/1.0/mp3/<data>")
 def mp3(data):
 	req = AudioServerRequest.decode(data)
-	req.validate(MP3Settings)
-	encoder = MP3Encoder()
-	mp3 = encoder(req.filePath, req.headerSpec, **req.settings)
-	return send_file(StringIO(mp3), mimetype="audio/mpeg3")
+	req.validate(MP3Settings, checkFileExists=False)
+	return sendCached(req, "mp3", MP3Settings, "audio/mpeg3", encode, mp3Encoder, MP3Settings, req)
 
 
 @app.route("/api/1.0/ogg/<data>")
 def ogg(data):
 	req = AudioServerRequest.decode(data)
-	req.validate(OggSettings)
-	encoder = OggEncoder()
-	ogg = encoder(req.filePath, req.headerSpec, **req.settings)
-	return send_file(StringIO(ogg), mimetype="audio/ogg")
+	req.validate(OggSettings, checkFileExists=False)
+	return sendCached(req, "ogg", OggSettings, "audio/ogg", encode, oggEncoder, OggSettings, req)
 
 
 @app.route("/api/1.0/waveform/<data>")
 def waveform(data):
 	req = AudioServerRequest.decode(data)
-	req.validate(WaveformSettings)
-	w = WavFile(req.filePath, req.headerSpec)
-	fp = StringIO(w.header + w.data)
+	req.validate(WaveformSettings, checkFileExists=False)
 
 	# translate colour setting
 	settings = copy.deepcopy(req.settings)
@@ -49,10 +280,141 @@ def waveform(data):
 		settings.update(WaveformSettings.translateColours(colour))
 		del settings["colour"]
 	
+	return sendCached(req, "waveform", WaveformSettings, "image/png", generateWaveform, req.filePath, req.headerSpec, settings)
+
+
+@app.route("/api/1.0/info/<data>")
+def info(data):
+	"""
+	Returns the metadata of an audio file, or of
+	every file in a directory if filePath is one.
+	"""
+	req = AudioServerRequest.decode(data)
+	req.validate(InfoSettings, checkFileExists=False)
+
+	if os.path.isdir(req.filePath):
+		recursive = bool(int(req.settings.get("recursive", 0)))
+		files = offload(audioProbe.probeDirectory, req.filePath, req.headerSpec, recursive)
+		return jsonify(files=files)
+
+	if not os.path.isfile(req.filePath):
+		raise ValueError("Audio file does not exist: %s" %req.filePath)
+
+	return jsonify(offload(audioProbe, req.filePath, req.headerSpec))
+
+
+@app.route("/api/1.0/validator/<type>/<data>")
+def validator(type, data):
+	"""
+	Returns the current ETag of a request's output,
+	so replicas can check their cached copy.
+	"""
+	if type not in CACHED_TYPES:
+		abort(404)
+
+	req = AudioServerRequest.decode(data)
+	req.validate(CACHED_TYPES[type], checkFileExists=False)
+
+	if not os.path.isfile(req.filePath):
+		abort(404)
+
+	etag, lastModified = req.validator(type, CACHED_TYPES[type])
+	return jsonify(etag=etag, lastModified=lastModified)
+
+
+@app.route("/api/1.0/cache/<key>", methods=["GET", "PUT"])
+def cache(key):
+	"""
+	Lets other nodes check for (GET/HEAD) and store
+	(PUT) cached artefacts.
+	"""
+	if artefactCache is None:
+		abort(404)
+
+	try:
+		artefactCache.path(key)
+	except ValueError:
+		abort(400)
+
+	if request.method == "PUT":
+		data = request.get_data()
+		try:
+			lastModified = int(request.headers.get(ArtefactCache.LAST_MODIFIED_HEADER, 0))
+		except ValueError:
+			abort(400)
+		meta = dict(
+			etag=request.headers.get(ArtefactCache.ETAG_HEADER, ""),
+			lastModified=lastModified,
+			mimetype=request.mimetype,
+		)
+		signature = ArtefactCache.sign(AudioServerRequest.SECRET_KEY, key, meta, data)
+		received = request.headers.get(ArtefactCache.SIGNATURE_HEADER, "")
+		if isinstance(received, unicode):
+			received = received.encode("latin-1")
+		if not hmac.compare_digest(signature, received):
+			abort(403)
+		offload(artefactCache.put, key, data, meta)
+		return Response(status=204)
+
+	# existence checks from triage - don't read the artefact
+	if request.method == "HEAD":
+		if not artefactCache.has(key):
+			abort(404)
+		return Response(status=200)
+
+	cached = offload(artefactCache.get, key)
+	if cached is None:
+		abort(404)
+
+	fp, meta = cached
+	return sendFile(fp, meta["mimetype"])
+
+
+@app.route("/api/1.0/status/scheduler")
+def schedulerStatus():
+	"""
+	Queue lengths and wait times per priority class.
+	"""
+	return jsonify(dict((type, scheduler.stats) for type, scheduler in schedulers.items()))
+
+
+def encode(encoder, settingValidator, req):
+	"""
+	Encodes the requested audio, passing it through
+	the gain stage first if gain/normalize is set.
+	"""
+	gainSettings, settings = settingValidator.splitGain(req.settings)
+
+	if not gainSettings:
+		return encoder(req.filePath, req.headerSpec, **settings)
+
+	from utils import GainStage
+
+	info = audioProbe(req.filePath, req.headerSpec)
+	with GainStage(req.filePath, req.headerSpec, info, **gainSettings) as (filePath, headerSpec):
+		return encoder(filePath, headerSpec, **settings)
+
+
+def generateWaveform(filePath, headerSpec, settings):
+	from lib.wavfile import WavFile
+	from utils import WaveformGenerator
+
+	w = WavFile(filePath, headerSpec)
+	fp = StringIO(w.header + w.data)
 	waveformGenerator = WaveformGenerator(**settings)
-	waveform = waveformGenerator(fp)
-	return send_file(StringIO(waveform), mimetype="image/png")
+	return waveformGenerator(fp)
 
 
 if __name__ == '__main__':
-	app.run()
+	parser = ArgumentParser()
+	parser.add_argument("--host", type=str, default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=5000)
+	parser.add_argument("--no-debug", action="store_true", default=False, help="Run without the debugger and reloader")
+	args = parser.parse_args()
+
+	debug = app.debug and not args.no_debug
+	# only in the process serving requests, not the reloader's parent
+	if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+		startEncoders()
+
+	app.run(args.host, args.port, debug=debug)
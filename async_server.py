@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+Alternative entry point which serves the audio server (or the triage
+app) from a single gevent process.
+
+Sockets are cooperative, so clients slowly downloading large files only
+hold a greenlet rather than a whole worker, and blocking work (encoding,
+waveform generation) is pushed onto a thread pool so it doesn't stall
+the event loop. The routes are exactly those of app.py/triage.py.
+
+Usage:
+	python async_server.py --port 5000
+	python async_server.py --triage --port 5001
+"""
+
+from gevent import monkey
+# threads are left unpatched - the encoder pool is driven from real
+# threads in the gevent thread pool. So is os (with subprocess and signal,
+# which depend on it): encoder
+# workers are forked from those threads, where gevent's fork can't
+# attach a child watcher
+monkey.patch_all(thread=False, os=False, subprocess=False, signal=False)
+
+import gevent
+import gevent.event
+from argparse import ArgumentParser
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5000
+DEFAULT_IO_THREADS = 4        # threads for blocking work outside the schedulers (cache, probes)
+DEFAULT_MAX_CONNECTIONS = 10000
+
+
+def offload(func, *args, **kwArgs):
+	"""
+	Runs func in the hub's thread pool and waits
+	cooperatively for the result.
+	"""
+	return gevent.get_hub().threadpool.apply(func, args, kwArgs)
+
+
+def createServer(host=DEFAULT_HOST, port=DEFAULT_PORT, triage=False, threads=None, maxConnections=DEFAULT_MAX_CONNECTIONS):
+	"""
+	Jobs queued by the schedulers wait in their greenlet
+	and only reach the thread pool once admitted, so by
+	default the pool is sized to the schedulers' slots
+	plus a few threads for other blocking work.
+	"""
+	if triage:
+		# redirects only - nothing to offload
+		import triage as module
+
+	else:
+		import app as module
+		module.offload = offload
+		module.startEncoders()
+		for scheduler in module.schedulers.values():
+			scheduler.eventFactory = gevent.event.Event
+		if threads is None:
+			threads = sum(scheduler.slots for scheduler in module.schedulers.values()) + DEFAULT_IO_THREADS
+
+	if threads is not None:
+		gevent.get_hub().threadpool.maxsize = threads
+	return WSGIServer((host, port), module.app, spawn=Pool(maxConnections))
+
+
+def main():
+	parser = ArgumentParser()
+	parser.add_argument("--host", type=str, default=DEFAULT_HOST)
+	parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+	parser.add_argument("--triage", action="store_true", default=False, help="Serve the triage app instead of the audio server")
+	parser.add_argument("--threads", type=int, default=None, help="Threads available for blocking work (default: scheduler slots + %d)" %DEFAULT_IO_THREADS)
+	parser.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS)
+	args = parser.parse_args()
+
+	server = createServer(args.host, args.port, args.triage, args.threads, args.max_connections)
+	print "Serving on http://%s:%s" %(args.host, args.port)
+	server.serve_forever()
+
+
+if __name__ == '__main__':
+	main()
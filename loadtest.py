@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+
+"""
+Load tests the audio server.
+
+Fires concurrent requests (optionally from deliberately slow clients)
+at one or more running servers and reports throughput, latency
+percentiles and error rate for each, e.g. to compare the Flask app
+with async_server.py:
+
+	python app.py                          # port 5000
+	python async_server.py --port 5001
+	python loadtest.py --url http://localhost:5000 --url http://localhost:5001 --slow 65536
+
+With --cluster it instead starts N local audio servers and the triage
+app on loopback ports, generates synthetic audio, replays a mix of
+requests through the triage app and also reports CPU and memory use
+per server:
+
+	python loadtest.py --cluster 3 --mix mp3=5,ogg=3,waveform=2 --requests 500
+"""
+
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import wave
+from argparse import ArgumentParser
+from array import array
+from utils import AudioServerRequest, BULK, INTERACTIVE
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+AUDIO_DIR = os.path.join(ROOT_DIR, "audio")
+EXAMPLE_WAV_FILE = os.path.join(AUDIO_DIR, "example.wav")
+
+READ_SIZE = 4096 # bytes
+BASE_PORT = 15000
+STARTUP_TIMEOUT = 30 # seconds
+SYNTHETIC_RATE = 16000
+
+
+def fetch(url, bytesPerSecond=None):
+	"""
+	Downloads url, throttling the read rate if
+	bytesPerSecond is given. Returns bytes read.
+	"""
+	response = urllib2.urlopen(url)
+	total = 0
+
+	while True:
+		chunk = response.read(READ_SIZE)
+		if not chunk:
+			break
+		total += len(chunk)
+		if bytesPerSecond:
+			time.sleep(1.0 * len(chunk) / bytesPerSecond)
+
+	return total
+
+
+def percentile(values, p):
+	if not values:
+		return None
+	values = sorted(values)
+	index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+	return values[index]
+
+
+def run(urls, concurrency, bytesPerSecond=None):
+	"""
+	Fetches each (label, url) pair, spread over
+	concurrency client threads. Returns (elapsed,
+	results) where results is a list of (label,
+	latency, error).
+	"""
+	results = []
+	lock = threading.Lock()
+	queue = list(reversed(urls))
+
+	def client():
+		while True:
+			with lock:
+				if not queue:
+					return
+				label, url = queue.pop()
+
+			start = time.time()
+			try:
+				fetch(url, bytesPerSecond)
+			except Exception, e:
+				result = (label, None, e)
+			else:
+				result = (label, time.time() - start, None)
+
+			with lock:
+				results.append(result)
+
+	start = time.time()
+	threads = [threading.Thread(target=client) for i in range(concurrency)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	return time.time() - start, results
+
+
+def summarise(elapsed, results):
+	latencies = [latency for label, latency, error in results if error is None]
+	errors = len(results) - len(latencies)
+
+	return {
+		"requests" : len(results),
+		"errors" : errors,
+		"errorRate" : 1.0 * errors / len(results) if results else 0.0,
+		"elapsed" : elapsed,
+		"throughput" : len(latencies) / elapsed if elapsed else 0.0,
+		"p50" : percentile(latencies, 50),
+		"p95" : percentile(latencies, 95),
+		"p99" : percentile(latencies, 99),
+	}
+
+
+def formatResult(name, result):
+	def ms(value):
+		return "-" if value is None else "%.1fms" %(value * 1000)
+
+	return "%s: %d requests, %d errors (%.1f%%), %.2fs, %.1f req/s, p50 %s, p95 %s, p99 %s" %(
+		name, result["requests"], result["errors"], result["errorRate"] * 100, result["elapsed"], result["throughput"],
+		ms(result["p50"]), ms(result["p95"]), ms(result["p99"]))
+
+
+def parseMix(s):
+	"""
+	Parses "mp3=5,ogg=3" into [("mp3", 5), ("ogg", 3)].
+	"""
+	mix = []
+
+	for pair in s.split(","):
+		type, weight = pair.split("=")
+		if type not in ("mp3", "ogg", "waveform"):
+			raise ValueError("Unknown request type: %r" %type)
+		mix.append((type, float(weight)))
+
+	return mix
+
+
+def chooseWeighted(rand, mix):
+	target = rand.random() * sum(weight for type, weight in mix)
+	for type, weight in mix:
+		target -= weight
+		if target < 0:
+			return type
+	return mix[-1][0]
+
+
+def generateAudio(directory, count, duration, rate=SYNTHETIC_RATE):
+	"""
+	Writes count mono 16 bit WAV files of tones and
+	noise, duration seconds long. Returns their paths.
+	"""
+	rand = random.Random(0)
+	paths = []
+
+	for i in range(count):
+		path = os.path.join(directory, "synthetic%03d.wav" %i)
+		frequency = 100 + 50 * i
+		level = 0.1 + 0.8 * rand.random()
+
+		w = wave.open(path, "wb")
+		w.setnchannels(1)
+		w.setsampwidth(2)
+		w.setframerate(rate)
+
+		# write a second at a time
+		for second in range(int(math.ceil(duration))):
+			frames = min(rate, int(duration * rate) - second * rate)
+			samples = array("h", (int(32767 * level * (0.8 * math.sin(2 * math.pi * frequency * (second * rate + n) / rate) + 0.2 * (rand.random() * 2 - 1))) for n in range(frames)))
+			w.writeframes(samples.tostring())
+
+		w.close()
+		paths.append(path)
+
+	return paths
+
+
+def buildRequests(paths, mix, count, bulkFraction=0.0, seed=0):
+	"""
+	Returns count (type, AudioServerRequest) pairs
+	drawn from the mix.
+	"""
+	rand = random.Random(seed)
+	requests = []
+
+	for i in range(count):
+		type = chooseWeighted(rand, mix)
+		priority = BULK if rand.random() < bulkFraction else INTERACTIVE
+		req = AudioServerRequest(filePath=rand.choice(paths), priority=priority, client="loadtest%d" %(i % 4))
+		requests.append((type, req))
+
+	return requests
+
+
+def processTree(pid):
+	"""
+	Returns pid and the pids of all its descendants
+	(e.g. encoder workers).
+	"""
+	children = {}
+	for name in os.listdir("/proc"):
+		if not name.isdigit():
+			continue
+		try:
+			with open("/proc/%s/stat" %name) as fp:
+				ppid = int(fp.read().rsplit(")", 1)[1].split()[1])
+		except (IOError, IndexError, ValueError):
+			continue
+		children.setdefault(ppid, []).append(int(name))
+
+	pids = [pid]
+	for p in pids:
+		pids.extend(children.get(p, []))
+	return pids
+
+
+def resourceUsage(pid):
+	"""
+	Returns (cpu seconds, rss bytes) for a process
+	and its descendants, read from /proc (Linux only).
+	Returns None where /proc isn't available.
+	"""
+	if not os.path.isdir("/proc"):
+		return None
+
+	clockTicks = os.sysconf("SC_CLK_TCK")
+	pageSize = os.sysconf("SC_PAGE_SIZE")
+	cpu = 0.0
+	rss = 0
+
+	for p in processTree(pid):
+		try:
+			with open("/proc/%d/stat" %p) as fp:
+				fields = fp.read().rsplit(")", 1)[1].split()
+		except IOError:
+			continue
+		cpu += (int(fields[11]) + int(fields[12])) / float(clockTicks)
+		rss += int(fields[21]) * pageSize
+
+	return cpu, rss
+
+
+def waitForPort(port, timeout=STARTUP_TIMEOUT):
+	deadline = time.time() + timeout
+
+	while time.time() < deadline:
+		try:
+			socket.create_connection(("127.0.0.1", port), 1).close()
+			return
+		except socket.error:
+			time.sleep(0.1)
+
+	raise RuntimeError("Server on port %d didn't start within %ss" %(port, timeout))
+
+
+class Cluster(object):
+	"""
+	N local audio servers plus the triage app, each
+	on its own loopback port with its own cache
+	directory.
+	"""
+
+	def __init__(self, nodes, workDir, basePort=BASE_PORT, server="app.py"):
+		self.nodes = nodes
+		self.workDir = workDir
+		self.basePort = basePort
+		self.server = server
+		self.processes = {}
+		self.names = ["node%d" %(i + 1) for i in range(nodes)]
+		self.urls = dict((name, "http://127.0.0.1:%d" %(basePort + 1 + i)) for i, name in enumerate(self.names))
+		self.triageURL = "http://127.0.0.1:%d" %basePort
+
+	def start(self):
+		env = dict(os.environ)
+		env["AUDIO_SERVER_SECRET_KEY"] = AudioServerRequest.SECRET_KEY
+		env["AUDIO_SERVER_NODES"] = ",".join("%s=%s" %(name, self.urls[name]) for name in self.names)
+		# the nodes share the synthetic audio, so spread misses over them
+		env["AUDIO_SERVER_FALLBACK"] = "ring"
+
+		logFile = open(os.path.join(self.workDir, "cluster.log"), "w")
+
+		for i, name in enumerate(self.names):
+			nodeEnv = dict(env)
+			nodeEnv["AUDIO_SERVER_NODE"] = name
+			nodeEnv["AUDIO_SERVER_CACHE_DIR"] = os.path.join(self.workDir, "cache", name)
+			args = [self.server, "--port", str(self.basePort + 1 + i)]
+			if self.server == "app.py":
+				args.append("--no-debug")
+			self.spawn(name, args, nodeEnv, logFile)
+
+		self.spawn("triage", ["triage.py", "--port", str(self.basePort), "--no-debug"], env, logFile)
+
+		for i in range(self.nodes + 1):
+			waitForPort(self.basePort + i)
+
+	def spawn(self, name, args, env, logFile):
+		# each in its own process group so stop() also gets its children
+		self.processes[name] = subprocess.Popen([sys.executable] + args, cwd=ROOT_DIR, env=env, stdout=logFile, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+	def usage(self):
+		return dict((name, resourceUsage(process.pid)) for name, process in self.processes.items())
+
+	def stop(self):
+		"""
+		Stops whichever servers were started.
+		"""
+		for process in self.processes.values():
+			try:
+				os.killpg(process.pid, signal.SIGTERM)
+			except OSError:
+				pass
+		for process in self.processes.values():
+			process.wait()
+
+
+def runCluster(args):
+	if AudioServerRequest.SECRET_KEY is None:
+		AudioServerRequest.SECRET_KEY = os.urandom(32).encode("hex")
+
+	workDir = tempfile.mkdtemp(prefix="audioserver-loadtest-")
+	audioDir = os.path.join(workDir, "audio")
+	os.makedirs(audioDir)
+
+	try:
+		print "Generating %d synthetic files in %s" %(args.files, audioDir)
+		paths = generateAudio(audioDir, args.files, args.duration)
+		requests = buildRequests(paths, parseMix(args.mix), args.requests, args.bulk, args.seed)
+
+		cluster = Cluster(args.cluster, workDir, args.port, args.server)
+
+		# the servers run in their own process groups, so don't get the
+		# terminal's signals - make sure they're stopped on ours
+		def terminate(signum, frame):
+			raise SystemExit(128 + signum)
+		for signum in (signal.SIGTERM, signal.SIGHUP):
+			signal.signal(signum, terminate)
+
+		try:
+			print "Starting %d audio servers and triage from port %d" %(args.cluster, args.port)
+			cluster.start()
+
+			before = cluster.usage()
+			urls = [(type, req.buildURL(cluster.triageURL, type)) for type, req in requests]
+			elapsed, results = run(urls, args.concurrency, args.slow)
+			after = cluster.usage()
+
+		finally:
+			cluster.stop()
+
+		print formatResult("all", summarise(elapsed, results))
+		for type in sorted(set(label for label, latency, error in results)):
+			print formatResult(type, summarise(elapsed, [result for result in results if result[0] == type]))
+
+		for name in sorted(after):
+			if before.get(name) is None or after[name] is None:
+				print "%s: resource usage unavailable" %name
+				continue
+			cpu = after[name][0] - before[name][0]
+			print "%s: cpu %.2fs (%.0f%%), rss %.1fMB" %(name, cpu, 100 * cpu / elapsed if elapsed else 0, after[name][1] / 1048576.0)
+
+		errors = [error for label, latency, error in results if error is not None]
+		if errors:
+			print "First error: %r (server logs in %s)" %(errors[0], os.path.join(workDir, "cluster.log"))
+
+	finally:
+		if not args.keep:
+			shutil.rmtree(workDir, ignore_errors=True)
+
+
+def main():
+	parser = ArgumentParser()
+	parser.add_argument("--url", type=str, action="append", help="Application URL (repeat to compare servers)")
+	parser.add_argument("--type", type=str, default="mp3", choices=["mp3", "ogg", "waveform"])
+	parser.add_argument("--file", type=str, default=EXAMPLE_WAV_FILE, help="Audio file to request")
+	parser.add_argument("--requests", type=int, default=200)
+	parser.add_argument("--concurrency", type=int, default=50)
+	parser.add_argument("--slow", type=int, default=None, help="Throttle each client to this many bytes/second")
+
+	group = parser.add_argument_group("cluster mode")
+	group.add_argument("--cluster", type=int, default=None, help="Start this many local audio servers plus triage")
+	group.add_argument("--server", type=str, default="app.py", choices=["app.py", "async_server.py"], help="Entry point for the audio servers")
+	group.add_argument("--port", type=int, default=BASE_PORT, help="Triage port; audio servers use the following ports")
+	group.add_argument("--mix", type=str, default="mp3=5,ogg=3,waveform=2", help="Request type weights")
+	group.add_argument("--bulk", type=float, default=0.0, help="Fraction of requests sent with bulk priority")
+	group.add_argument("--files", type=int, default=10, help="Number of synthetic audio files")
+	group.add_argument("--duration", type=float, default=10.0, help="Length of each synthetic file (seconds)")
+	group.add_argument("--seed", type=int, default=0)
+	group.add_argument("--keep", action="store_true", default=False, help="Keep the working directory (audio, caches, logs)")
+	args = parser.parse_args()
+
+	if args.cluster:
+		runCluster(args)
+		return
+
+	appURLs = args.url or ["http://localhost:5000"]
+	req = AudioServerRequest(filePath=args.file)
+
+	for appURL in appURLs:
+		url = req.buildURL(appURL, args.type)
+		elapsed, results = run([(args.type, url)] * args.requests, args.concurrency, args.slow)
+		print formatResult(appURL, summarise(elapsed, results))
+
+
+if __name__ == '__main__':
+	main()
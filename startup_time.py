@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+Measures how long it takes to import the application modules.
+
+Each target is imported in a fresh interpreter so earlier imports don't
+hide its cost. The report lists the total for each target followed by
+the slowest modules it pulled in (cumulative time, including their own
+imports).
+
+	python startup_time.py
+	python startup_time.py app triage utils.WaveformGenerator --top 20
+"""
+
+import __builtin__
+import os
+import simplejson
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, SUPPRESS
+
+
+DEFAULT_TARGETS = ["utils", "triage", "app", "utils.GainStage", "utils.WaveformGenerator"]
+DEFAULT_TOP = 10
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def resolve(name, globals):
+	"""
+	Returns the name a module is loaded under,
+	allowing for implicit relative imports.
+	"""
+	if globals:
+		package = globals.get("__name__", "")
+		if "__path__" not in globals:
+			package = package.rpartition(".")[0]
+		# failed relative lookups leave None entries behind
+		if package and sys.modules.get("%s.%s" %(package, name)) is not None:
+			return "%s.%s" %(package, name)
+
+	return name
+
+
+def measure(target):
+	"""
+	Imports target with __import__ wrapped to record
+	the time spent on each module's first import.
+	Returns (total, {module : seconds}).
+	"""
+	timings = {}
+	originalImport = __builtin__.__import__
+
+	def timedImport(name, globals=None, *args, **kwArgs):
+		if sys.modules.get(resolve(name, globals)) is not None:
+			return originalImport(name, globals, *args, **kwArgs)
+
+		start = time.time()
+		try:
+			return originalImport(name, globals, *args, **kwArgs)
+		finally:
+			key = resolve(name, globals)
+			if sys.modules.get(key) is not None and key not in timings:
+				timings[key] = time.time() - start
+
+	__builtin__.__import__ = timedImport
+	start = time.time()
+	try:
+		__import__(target)
+	finally:
+		__builtin__.__import__ = originalImport
+
+	return time.time() - start, timings
+
+
+def runChild(target):
+	"""
+	Measures target in a fresh interpreter.
+	"""
+	process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", target], cwd=ROOT_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	stdout, stderr = process.communicate()
+
+	if process.returncode != 0:
+		raise RuntimeError(stderr.strip().splitlines()[-1] if stderr.strip() else "exit status %d" %process.returncode)
+
+	result = simplejson.loads(stdout)
+	return result["total"], result["timings"]
+
+
+def main():
+	parser = ArgumentParser()
+	parser.add_argument("targets", nargs="*", default=DEFAULT_TARGETS, help="Modules to import")
+	parser.add_argument("--top", type=int, default=DEFAULT_TOP, help="Number of slowest modules to list per target")
+	parser.add_argument("--child", type=str, default=None, help=SUPPRESS)
+	args = parser.parse_args()
+
+	if args.child is not None:
+		sys.path.insert(0, ROOT_DIR)
+		total, timings = measure(args.child)
+		print simplejson.dumps({"total" : total, "timings" : timings})
+		return
+
+	for target in args.targets:
+		try:
+			total, timings = runChild(target)
+		except RuntimeError, e:
+			print "%s: failed (%s)" %(target, e)
+			continue
+
+		print "%s: %.1fms" %(target, total * 1000)
+		slowest = sorted(timings.items(), key=lambda item: item[1], reverse=True)[:args.top]
+		for name, seconds in slowest:
+			print "\t%8.1fms  %s" %(seconds * 1000, name)
+
+
+if __name__ == '__main__':
+	main()
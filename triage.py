@@ -5,28 +5,88 @@ Note: this has not been tested. It is just an illustration of the general concep
 """
 
 import os
+from argparse import ArgumentParser
 from flask import Flask, redirect, abort
-from utils import AudioServerRequest
+from utils import AudioServerRequest, MP3Settings, OggSettings, WaveformSettings, ArtefactCache, HashRing, parseNodes
 
 class Config(object):
 	DEBUG = True
-	SERVERS = {
+	SERVERS = parseNodes(os.environ.get("AUDIO_SERVER_NODES", "")) or {
 		"audio" : "https://audio-storage1.appen.com",
 		"audio2" : "https://audio-storage2.appen.com",
 		"audio3" : "https://audio-storage3.appen.com",
 	}
-	DEFAULT_SERVER = "audio"
+	DEFAULT_SERVER = os.environ.get("AUDIO_SERVER_DEFAULT_NODE", "audio")
+	FALLBACK = os.environ.get("AUDIO_SERVER_FALLBACK", "default") # "default" or "ring", for audio not under a server's name
+	CACHE_REPLICAS = 2
+	CACHE_CHECK_TIMEOUT = 0.5 # seconds
+
+# types whose output is cached, and their settings
+CACHED_TYPES = {
+	"mp3" : MP3Settings,
+	"ogg" : OggSettings,
+	"waveform" : WaveformSettings,
+}
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
+ring = HashRing(app.config["SERVERS"].keys())
+
+
+def findReplica(req, type):
+	"""
+	Returns the first server responsible for the
+	request's artefact which already holds it, or
+	None if none do (or are reachable).
+	"""
+	key = req.cacheKey(type, CACHED_TYPES[type])
+
+	for server in ring.nodes(key, app.config["CACHE_REPLICAS"]):
+		if ArtefactCache.exists(app.config["SERVERS"][server], key, app.config["CACHE_CHECK_TIMEOUT"]):
+			return server
+
+	return None
+
+
+def fallbackServer(req, type):
+	"""
+	Returns the server for audio not under a server's
+	name: DEFAULT_SERVER, or with FALLBACK = "ring" (for
+	shared storage) the artefact's first replica, so
+	misses are spread over the servers and generated
+	where they'll be cached.
+	"""
+	if app.config["FALLBACK"] != "ring":
+		return app.config["DEFAULT_SERVER"]
+
+	key = req.cacheKey(type, CACHED_TYPES[type]) if type in CACHED_TYPES else req.filePath
+	return ring.nodes(key)[0]
+
 
 @app.route("/api/<version>/<type>/<data>")
 def controller(version, type, data):
 	req = AudioServerRequest.decode(data)
-	server = req.filePath.split("/")[1]
-	if server not in app.config["SERVERS"]:
-		server = app.config["DEFAULT_SERVER"]
+
+	server = None
+	if type in CACHED_TYPES:
+		server = findReplica(req, type)
+
+	# fall back to the server hosting the audio
+	if server is None:
+		server = req.filePath.split("/")[1]
+		if server not in app.config["SERVERS"]:
+			server = fallbackServer(req, type)
+
 	baseURL = app.config["SERVERS"][server]
 	redirectURL = os.path.join(baseURL, "api", version, type, data)
 	return redirect(redirectURL)
+
+
+if __name__ == '__main__':
+	parser = ArgumentParser()
+	parser.add_argument("--host", type=str, default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=5000)
+	parser.add_argument("--no-debug", action="store_true", default=False, help="Run without the debugger and reloader")
+	args = parser.parse_args()
+	app.run(args.host, args.port, debug=app.debug and not args.no_debug)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""
+On-disk cache of derived artefacts (encoded MP3/Ogg, waveforms) which
+can be replicated to the other audio servers responsible for them.
+"""
+
+import hashlib
+import hmac
+import os
+import re
+import simplejson
+import tempfile
+import threading
+import urllib2
+
+
+KEY_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+DEFAULT_TIMEOUT = 10 # seconds
+EVICT_TO = 0.9 # fraction of maxBytes left after eviction, so it isn't needed on every write
+
+
+class ArtefactCache(object):
+	"""
+	Stores each artefact as <key> alongside a
+	<key>.json file holding its etag, lastModified
+	and mimetype. Writes are atomic renames so
+	concurrent readers never see partial files.
+
+	If maxBytes is given, the least recently used
+	artefacts (by mtime, which is refreshed on each
+	read) are evicted to keep the directory under
+	that size. A running total of the cache size is
+	kept so the directory is only scanned when it
+	is over.
+	"""
+
+	# replication headers
+	ETAG_HEADER = "X-Artefact-ETag"
+	LAST_MODIFIED_HEADER = "X-Artefact-Last-Modified"
+	SIGNATURE_HEADER = "X-Artefact-Signature"
+
+	def __init__(self, directory, maxBytes=None):
+		self.directory = directory
+		self.maxBytes = maxBytes
+		self.total = None # bytes, counted by the first evict()
+		self.lock = threading.Lock()
+		self.evictLock = threading.Lock()
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def path(self, key):
+		if not KEY_PATTERN.match(key):
+			raise ValueError("Invalid artefact key: %r" %key)
+		return os.path.join(self.directory, key)
+
+	def has(self, key):
+		return os.path.isfile(self.path(key) + ".json")
+
+	def get(self, key):
+		"""
+		Returns (fp, meta) or None if the artefact
+		isn't cached. fp is an open file which the
+		caller must close (send_file does).
+		"""
+		path = self.path(key)
+
+		try:
+			with open(path + ".json") as fp:
+				meta = simplejson.load(fp)
+			fp = open(path, "rb")
+		except IOError:
+			return None
+
+		# mark as recently used
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+
+		return fp, meta
+
+	def put(self, key, data, meta):
+		path = self.path(key)
+		replaced = self.size(path)
+		self.write(path, data)
+		# metadata last - it marks the artefact as complete
+		self.write(path + ".json", simplejson.dumps(meta))
+		self.count(self.size(path) - replaced)
+
+		if self.maxBytes is not None and (self.total is None or self.total > self.maxBytes):
+			self.evict()
+
+	def remove(self, key):
+		path = self.path(key)
+		size = self.size(path)
+		self.delete(path)
+		self.count(-size)
+
+	def count(self, change):
+		with self.lock:
+			if self.total is not None:
+				self.total += change
+
+	@staticmethod
+	def size(path):
+		"""
+		Returns the size of an artefact and its
+		metadata, or 0 if it isn't cached.
+		"""
+		try:
+			return os.path.getsize(path) + os.path.getsize(path + ".json")
+		except OSError:
+			return 0
+
+	@staticmethod
+	def delete(path):
+		# metadata first so readers treat it as a miss
+		for filePath in (path + ".json", path):
+			try:
+				os.remove(filePath)
+			except OSError:
+				pass
+
+	def evict(self):
+		"""
+		Scans the directory, correcting the running
+		total, and removes the least recently used
+		artefacts until the cache is within EVICT_TO
+		of maxBytes.
+		"""
+		if self.maxBytes is None:
+			return
+
+		with self.evictLock:
+			artefacts = []
+			total = 0
+
+			for name in os.listdir(self.directory):
+				if not KEY_PATTERN.match(name):
+					continue
+				path = os.path.join(self.directory, name)
+				try:
+					stat = os.stat(path)
+					size = stat.st_size + os.path.getsize(path + ".json")
+				except OSError:
+					continue
+				artefacts.append((stat.st_mtime, size, path))
+				total += size
+
+			if total > self.maxBytes:
+				for mtime, size, path in sorted(artefacts):
+					if total <= self.maxBytes * EVICT_TO:
+						break
+					self.delete(path)
+					total -= size
+
+			with self.lock:
+				self.total = total
+
+	def write(self, path, contents):
+		fd, tempPath = tempfile.mkstemp(dir=self.directory)
+		try:
+			with os.fdopen(fd, "wb") as fp:
+				fp.write(contents)
+			os.rename(tempPath, path)
+		except Exception:
+			if os.path.exists(tempPath):
+				os.remove(tempPath)
+			raise
+
+	@staticmethod
+	def sign(secretKey, key, meta, data):
+		"""
+		Signs an artefact so replicas only accept
+		copies pushed by other audio servers.
+		"""
+		message = "|".join([key, meta["etag"], str(meta["lastModified"]), meta["mimetype"], hashlib.sha1(data).hexdigest()])
+		return hmac.new(secretKey or "", message, hashlib.sha1).hexdigest()
+
+	@classmethod
+	def push(cls, baseURL, key, meta, data, secretKey, timeout=DEFAULT_TIMEOUT):
+		"""
+		Stores an artefact on another audio server.
+		"""
+		url = os.path.join(baseURL, "api", "1.0", "cache", key)
+		request = urllib2.Request(url, data, {
+			"Content-Type" : meta["mimetype"],
+			cls.ETAG_HEADER : meta["etag"],
+			cls.LAST_MODIFIED_HEADER : str(meta["lastModified"]),
+			cls.SIGNATURE_HEADER : cls.sign(secretKey, key, meta, data),
+		})
+		request.get_method = lambda: "PUT"
+		urllib2.urlopen(request, timeout=timeout).read()
+
+	@staticmethod
+	def currentETag(baseURL, type, data, timeout=DEFAULT_TIMEOUT):
+		"""
+		Asks the server hosting the audio for the
+		current ETag of a request's output (data is the
+		encoded request). Returns None if it can't be
+		reached.
+		"""
+		url = os.path.join(baseURL, "api", "1.0", "validator", type, data)
+
+		try:
+			return simplejson.load(urllib2.urlopen(url, timeout=timeout))["etag"]
+		except (urllib2.URLError, IOError, ValueError, KeyError):
+			return None
+
+	@staticmethod
+	def exists(baseURL, key, timeout=DEFAULT_TIMEOUT):
+		"""
+		Asks another audio server whether it holds an
+		artefact. Unreachable servers count as not
+		holding it.
+		"""
+		url = os.path.join(baseURL, "api", "1.0", "cache", key)
+		request = urllib2.Request(url)
+		request.get_method = lambda: "HEAD"
+
+		try:
+			urllib2.urlopen(request, timeout=timeout)
+		except (urllib2.URLError, IOError):
+			return False
+
+		return True
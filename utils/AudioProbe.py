@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""
+Reads audio file metadata (sample encoding, rate, width, channels, frames,
+duration and data offset) from RIFF/WAVE headers or, for raw files, from the header
+spec. Results are cached in memory keyed on the file's path, mtime and
+size, and optionally persisted to SQLite so they survive restarts.
+"""
+
+import os
+import sqlite3
+import struct
+import threading
+from collections import OrderedDict
+from HeaderSpec import HeaderSpec
+
+
+DEFAULT_CACHE_SIZE = 4096 # entries
+
+# sample widths (bits) implied by the raw formats
+RAW_WIDTHS = {
+	HeaderSpec.ALAW : 8,
+	HeaderSpec.MULAW : 8,
+}
+
+# WAVE format tags -> sample encoding
+WAVE_ENCODINGS = {
+	0x0001 : HeaderSpec.PCM,
+	0x0003 : "float",
+	0x0006 : HeaderSpec.ALAW,
+	0x0007 : HeaderSpec.MULAW,
+}
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class ProbeError(ValueError): pass
+
+
+def waveEncoding(audioFormat, extension):
+	"""
+	Returns the sample encoding for a WAVE format
+	tag, looking at the subformat GUID of extensible
+	files (whose first two bytes are the format tag).
+	The extension is validBits (2), channelMask (4)
+	then the GUID (16).
+	"""
+	if audioFormat == WAVE_FORMAT_EXTENSIBLE:
+		if len(extension) < 22:
+			raise ProbeError("Invalid extensible fmt chunk")
+		audioFormat, = struct.unpack("<H", extension[6:8])
+
+	return WAVE_ENCODINGS.get(audioFormat, "unknown(0x%04x)" %audioFormat)
+
+
+def probeWav(fp, fileSize):
+	"""
+	Walks the RIFF chunks of a WAVE file and
+	returns its metadata.
+	"""
+	riff, riffSize, wave = struct.unpack("<4sI4s", fp.read(12))
+	if riff != "RIFF" or wave != "WAVE":
+		raise ProbeError("Not a RIFF/WAVE file")
+
+	fmt = None
+
+	while True:
+		header = fp.read(8)
+		if len(header) < 8:
+			raise ProbeError("No data chunk found")
+
+		chunkId, chunkSize = struct.unpack("<4sI", header)
+
+		if chunkId == "fmt ":
+			if chunkSize < 16:
+				raise ProbeError("Invalid fmt chunk")
+			fmt = struct.unpack("<HHIIHH", fp.read(16))
+			# cbSize followed by the extension, if any
+			extension = fp.read(chunkSize - 16)[2:]
+			fp.seek(chunkSize % 2, os.SEEK_CUR)
+
+		elif chunkId == "data":
+			if fmt is None:
+				raise ProbeError("data chunk found before fmt chunk")
+
+			dataOffset = fp.tell()
+
+			# streamed files may leave the size unset
+			if chunkSize in (0, 0xFFFFFFFF) or dataOffset + chunkSize > fileSize:
+				chunkSize = fileSize - dataOffset
+
+			audioFormat, channels, rate, byteRate, blockAlign, width = fmt
+			return {
+				"fmt" : HeaderSpec.WAV,
+				"encoding" : waveEncoding(audioFormat, extension),
+				"rate" : rate,
+				"width" : width,
+				"channels" : channels,
+				"frames" : chunkSize // blockAlign if blockAlign else 0,
+				"dataOffset" : dataOffset,
+			}
+
+		else:
+			fp.seek(chunkSize + (chunkSize % 2), os.SEEK_CUR)
+
+
+def probeRaw(headerSpec, fileSize):
+	"""
+	Returns metadata for a headerless file
+	described by the header spec.
+	"""
+	width = headerSpec.width or RAW_WIDTHS.get(headerSpec.fmt)
+	channels = headerSpec.channels or 1
+
+	if width is None or headerSpec.rate is None:
+		raise ProbeError("Header spec must provide rate and width for %s files" %headerSpec.fmt)
+
+	return {
+		"fmt" : headerSpec.fmt,
+		"encoding" : headerSpec.fmt,
+		"rate" : headerSpec.rate,
+		"width" : width,
+		"channels" : channels,
+		"frames" : fileSize // (width // 8 * channels),
+		"dataOffset" : 0,
+	}
+
+
+def probe(filePath, headerSpec=None, fileSize=None):
+	"""
+	Reads the metadata of a single file without
+	any caching. Files starting with a RIFF header
+	are parsed as WAVE, anything else is treated as
+	raw audio described by the header spec.
+	"""
+	headerSpec = HeaderSpec(headerSpec)
+
+	if fileSize is None:
+		fileSize = os.path.getsize(filePath)
+
+	with open(filePath, "rb") as fp:
+		isRiff = fp.read(4) == "RIFF"
+		fp.seek(0)
+
+		if isRiff:
+			info = probeWav(fp, fileSize)
+		elif not headerSpec.isWav():
+			info = probeRaw(headerSpec, fileSize)
+		else:
+			raise ProbeError("Not a RIFF/WAVE file: %s. Provide a header spec for raw audio." %filePath)
+
+	info["duration"] = 1.0 * info["frames"] / info["rate"] if info["rate"] else 0.0
+	return info
+
+
+class AudioProbe(object):
+	"""
+	Caching front end for probe(). Entries are kept
+	in a bounded LRU keyed on path, mtime, size and
+	header spec, so modified files are re-probed. If
+	a database path is given, entries are also stored
+	in SQLite and loaded from there on a cache miss.
+	Storing an entry removes those for older versions
+	of the same file.
+	"""
+
+	FIELDS = ("fmt", "encoding", "rate", "width", "channels", "frames", "dataOffset", "duration")
+
+	# bump when the probes table changes - it only holds cached
+	# data, so tables from other versions are dropped and rebuilt
+	SCHEMA_VERSION = 2
+
+	def __init__(self, maxSize=DEFAULT_CACHE_SIZE, database=None):
+		self.maxSize = maxSize
+		self.cache = OrderedDict()
+		self.lock = threading.Lock()
+		self.db = None
+
+		if database is not None:
+			self.db = sqlite3.connect(database, check_same_thread=False)
+
+			version, = self.db.execute("PRAGMA user_version").fetchone()
+			if version != self.SCHEMA_VERSION:
+				self.db.execute("DROP TABLE IF EXISTS probes")
+
+			self.db.execute("""
+				CREATE TABLE IF NOT EXISTS probes (
+					key TEXT PRIMARY KEY,
+					source TEXT,
+					fmt TEXT,
+					encoding TEXT,
+					rate INTEGER,
+					width INTEGER,
+					channels INTEGER,
+					frames INTEGER,
+					dataOffset INTEGER,
+					duration REAL
+				)
+			""")
+			self.db.execute("CREATE INDEX IF NOT EXISTS probes_source ON probes (source)")
+			self.db.execute("PRAGMA user_version = %d" %self.SCHEMA_VERSION)
+			self.db.commit()
+
+	def __call__(self, filePath, headerSpec=None, commit=True):
+		"""
+		Returns the file's metadata. Pass commit=False
+		to leave the database write uncommitted when
+		probing in bulk, then call commit().
+		"""
+		stat = os.stat(filePath)
+		headerSpec = HeaderSpec(headerSpec)
+		path = os.path.abspath(filePath)
+		spec = ",".join(sorted(str(headerSpec).split(",")))
+		# source identifies the file, key this version of it
+		source = "%s|%s" %(path, spec)
+		key = "%s|%d|%d|%s" %(path, int(stat.st_mtime), stat.st_size, spec)
+
+		with self.lock:
+			info = self.cache.pop(key, None)
+			if info is None:
+				info = self.load(key)
+			if info is not None:
+				self.add(key, info)
+				return dict(info)
+
+		info = probe(filePath, headerSpec, stat.st_size)
+
+		with self.lock:
+			self.add(key, info)
+			self.store(key, source, info, commit)
+
+		return dict(info)
+
+	def add(self, key, info):
+		"""
+		Adds an entry as the most recently used,
+		evicting the least recently used beyond
+		maxSize. Must be called holding the lock.
+		"""
+		self.cache[key] = info
+		while len(self.cache) > self.maxSize:
+			self.cache.popitem(last=False)
+		assert len(self.cache) <= self.maxSize
+
+	def probeDirectory(self, dirPath, headerSpec=None, recursive=False):
+		"""
+		Probes every file in a directory. Returns a
+		dictionary of path -> metadata, where files
+		that can't be probed map to {"error" : message}.
+		"""
+		results = {}
+
+		# one commit for the whole batch
+		try:
+			for root, dirs, files in os.walk(dirPath):
+				for name in sorted(files):
+					filePath = os.path.join(root, name)
+					try:
+						results[filePath] = self(filePath, headerSpec, commit=False)
+					except (IOError, OSError, ValueError, struct.error), e:
+						results[filePath] = {"error" : str(e)}
+
+				if not recursive:
+					break
+		finally:
+			self.commit()
+
+		return results
+
+	def load(self, key):
+		if self.db is None:
+			return None
+
+		row = self.db.execute("SELECT %s FROM probes WHERE key = ?" %", ".join(self.FIELDS), (key,)).fetchone()
+		if row is None:
+			return None
+
+		return dict(zip(self.FIELDS, row))
+
+	def store(self, key, source, info, commit=True):
+		if self.db is None:
+			return
+
+		# entries for earlier mtimes/sizes of the file are stale
+		self.db.execute("DELETE FROM probes WHERE source = ? AND key != ?", (source, key))
+		self.db.execute("INSERT OR REPLACE INTO probes (key, source, %s) VALUES (?, ?, %s)" %(", ".join(self.FIELDS), ", ".join("?" * len(self.FIELDS))),
+			[key, source] + [info[field] for field in self.FIELDS])
+		if commit:
+			self.db.commit()
+
+	def commit(self):
+		with self.lock:
+			if self.db is not None:
+				self.db.commit()
+
+	def clear(self):
+		with self.lock:
+			self.cache.clear()
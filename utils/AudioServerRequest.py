@@ -1,24 +1,39 @@
 #!/usr/bin/env python
 
 import copy
+import hashlib
+import hmac
 import os
 import simplejson
 import urllib2
 from itsdangerous import URLSafeSerializer
 from HeaderSpec import HeaderSpec
+from Scheduler import INTERACTIVE, PRIORITIES
 
 
 class AudioServerRequest(object):
 	"""
 	Builds a client request for the audio server.
+
+	priority ("interactive" or "bulk") and client are
+	used to schedule the work. Like everything else in
+	the request they are signed, so can't be altered
+	without the secret key.
 	"""
 
 	SECRET_KEY = os.environ.get("AUDIO_SERVER_SECRET_KEY")
 
-	def __init__(self, filePath=None, headerSpec=None, settings=dict()):
+	# part of every ETag and cache key - bump whenever the output
+	# for a given request changes (encoder upgrades, DSP fixes), as
+	# responses are cached by clients as immutable
+	CACHE_VERSION = 1
+
+	def __init__(self, filePath=None, headerSpec=None, settings=dict(), priority=INTERACTIVE, client=None):
 		self.filePath = filePath
 		self.headerSpec = HeaderSpec(headerSpec)
 		self.settings = copy.deepcopy(settings)
+		self.priority = priority
+		self.client = client
 
 	def __call__(self, fp, *urlArgs, **urlKwArgs):
 		url = self.buildURL(*urlArgs, **urlKwArgs)
@@ -55,12 +70,67 @@ class AudioServerRequest(object):
 		if self.headerSpec is not None:
 			HeaderSpec(self.headerSpec)
 
+		if self.priority not in PRIORITIES:
+			raise ValueError("Invalid priority: %r. Expected one of: %s" %(self.priority, ", ".join(PRIORITIES)))
+
 		if self.settings:
 			if settingValidator is None:
 				raise ValueError("No setting validator provided.")
 
 			settingValidator.validate(self.settings)
 	
+	def cacheKey(self, type, settingValidator=None):
+		"""
+		Returns a key identifying the output of this
+		request for the given endpoint type. Unlike
+		validator() it doesn't need the audio file, so
+		any server can work out where the output is
+		cached. The key is an HMAC using SECRET_KEY, so
+		artefacts can't be fetched from the cache
+		without a signed request.
+		"""
+		settings = self.settings
+		if settingValidator is not None:
+			settings = settingValidator.canonical(settings)
+
+		key = simplejson.dumps([
+			self.CACHE_VERSION,
+			type,
+			self.filePath,
+			dict(self.headerSpec or {}),
+			settings,
+		], sort_keys=True)
+
+		return hmac.new(self.SECRET_KEY or "", key, hashlib.sha1).hexdigest()
+
+	def validator(self, type, settingValidator=None):
+		"""
+		Returns an (etag, lastModified) pair identifying
+		the output of this request for the given endpoint
+		type. Built from CACHE_VERSION, the source file's
+		identity (path, size, mtime) and the normalised
+		header spec and settings, so it can be computed
+		before any audio is read.
+		"""
+		stat = os.stat(self.filePath)
+		lastModified = int(stat.st_mtime)
+
+		settings = self.settings
+		if settingValidator is not None:
+			settings = settingValidator.canonical(settings)
+
+		key = simplejson.dumps([
+			self.CACHE_VERSION,
+			type,
+			os.path.abspath(self.filePath),
+			stat.st_size,
+			lastModified,
+			dict(self.headerSpec or {}),
+			settings,
+		], sort_keys=True)
+
+		return hashlib.sha1(key).hexdigest(), lastModified
+
 	@property
 	def jsonDict(self):
 		"""
@@ -75,6 +145,12 @@ class AudioServerRequest(object):
 		if self.settings:
 			d["settings"] = self.settings
 
+		if self.priority != INTERACTIVE:
+			d["priority"] = self.priority
+
+		if self.client is not None:
+			d["client"] = self.client
+
 		return d
 
 	@property
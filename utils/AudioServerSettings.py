@@ -60,6 +60,23 @@ class AudioServerSettings(dict):
 			if key not in d:
 				raise KeyError("Missing required field: %r" %key)
 
+	@classmethod
+	def canonical(cls, d):
+		"""
+		Returns a copy of the settings with each
+		value converted to its field's type, so that
+		equivalent settings compare equal.
+		"""
+		fields = cls.getFields()
+		normalized = {}
+
+		for key, value in d.items():
+			if key in fields and fields[key].type is not None:
+				value = fields[key].type(value)
+			normalized[key] = value
+
+		return normalized
+
 	@classmethod
 	def getFields(cls):
 		"""
@@ -76,15 +93,51 @@ class AudioServerSettings(dict):
 		return fields
 
 
-class MP3Settings(AudioServerSettings):
+class EncoderSettings(AudioServerSettings):
+	"""
+	Level adjustments applied before encoding.
+	gain is in dB, level is the normalisation
+	target in dBFS (defaults depend on normalize).
+	"""
+	gain = AudioServerSettings.Field(type=float, min=-60, max=60)
+	normalize = AudioServerSettings.Field(type=str, allowed=["peak", "rms"])
+	level = AudioServerSettings.Field(type=float, min=-60, max=0)
+
+	# fields consumed by the gain stage rather than the encoder
+	GAIN_FIELDS = ("gain", "normalize", "level")
+
+	@classmethod
+	def validate(cls, d):
+		super(EncoderSettings, cls).validate(d)
+
+		# level is only used as the normalisation target
+		if "level" in d and "normalize" not in d:
+			raise ValueError("Invalid 'level' field: only allowed with 'normalize'")
+
+	@classmethod
+	def splitGain(cls, d):
+		"""
+		Splits settings into (gain settings,
+		encoder settings).
+		"""
+		gainSettings = dict((key, value) for key, value in d.items() if key in cls.GAIN_FIELDS)
+		encoderSettings = dict((key, value) for key, value in d.items() if key not in cls.GAIN_FIELDS)
+		return gainSettings, encoderSettings
+
+
+class MP3Settings(EncoderSettings):
 	bitRate = AudioServerSettings.Field(type=int, allowed=[32, 64, 96, 128, 192, 256, 320])
 
 
-class OggSettings(AudioServerSettings): pass
+class OggSettings(EncoderSettings): pass
 	#TODO modify OggEncoder to allow specified bitRate
 	#bitRate = AudioServerSettings.Field(type=int, allowed=[32, 64, 96, 128, 192, 256, 320])
 
 
+class InfoSettings(AudioServerSettings):
+	recursive = AudioServerSettings.Field(type=int, allowed=[0, 1])
+
+
 class WaveformSettings(AudioServerSettings):
 	height = AudioServerSettings.Field(type=int, min=1)
 	width = AudioServerSettings.Field(type=int, min=1)
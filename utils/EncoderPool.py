@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+"""
+A pool of long-lived encoder worker processes.
+
+Constructing an encoder per request means paying process startup and
+library initialisation every time, which dominates for short clips.
+Each worker here builds its encoder once and then services jobs sent
+over a pipe until it has handled maxJobs requests, at which point it
+is recycled.
+"""
+
+import Queue
+import threading
+from multiprocessing import Pipe, Process
+
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_MAX_JOBS = 200      # jobs per worker before it is recycled
+DEFAULT_TIMEOUT = 300       # seconds to wait for a job to complete
+DEFAULT_PING_TIMEOUT = 5    # seconds to wait for a health check reply
+
+# messages
+ENCODE = "encode"
+PING = "ping"
+STOP = "stop"
+
+# replies
+OK = "ok"
+ERROR = "error"
+
+
+class EncoderPoolError(Exception): pass
+
+
+class EncoderJobError(EncoderPoolError):
+	"""
+	Raised when the encoder itself fails. The
+	worker is still healthy and can be reused.
+	"""
+
+
+def _workerMain(requests, replies, encoderClass, parentConns=()):
+	"""
+	Worker process loop. Builds the encoder once then
+	services requests until told to stop.
+	"""
+	# so that the requests pipe sees EOF if the parent dies
+	for conn in parentConns:
+		conn.close()
+
+	encoder = encoderClass()
+
+	while True:
+		try:
+			message = requests.recv()
+		except (EOFError, KeyboardInterrupt):
+			break
+
+		command = message[0]
+
+		if command == STOP:
+			break
+
+		elif command == PING:
+			replies.send((OK, None))
+
+		elif command == ENCODE:
+			filePath, headerSpec, settings = message[1:]
+			try:
+				result = encoder(filePath, headerSpec, **settings)
+			except Exception, e:
+				replies.send((ERROR, "%s: %s" %(type(e).__name__, e)))
+			else:
+				replies.send((OK, result))
+
+		else:
+			replies.send((ERROR, "Unknown command: %r" %command))
+
+	requests.close()
+	replies.close()
+
+
+class EncoderWorker(object):
+	"""
+	Handle on a single worker process.
+	"""
+
+	def __init__(self, encoderClass):
+		# a pair of one way (os.pipe) pipes rather than a duplex
+		# socketpair, which gevent's patched socket makes non-blocking
+		childRequests, self.requests = Pipe(duplex=False)
+		self.replies, childReplies = Pipe(duplex=False)
+		self.process = Process(target=_workerMain, args=(childRequests, childReplies, encoderClass, (self.requests, self.replies)))
+		self.process.daemon = True
+		self.process.start()
+		childRequests.close()
+		childReplies.close()
+		self.jobs = 0
+
+	def isAlive(self):
+		return self.process.is_alive()
+
+	def ping(self, timeout=DEFAULT_PING_TIMEOUT):
+		"""
+		Health check. Returns True if the worker
+		replies within the timeout.
+		"""
+		if not self.isAlive():
+			return False
+
+		try:
+			self.requests.send((PING,))
+			if not self.replies.poll(timeout):
+				return False
+			status, _ = self.replies.recv()
+		except (IOError, EOFError):
+			return False
+
+		return status == OK
+
+	def encode(self, filePath, headerSpec, settings, timeout=DEFAULT_TIMEOUT):
+		self.jobs += 1
+		self.requests.send((ENCODE, filePath, headerSpec, dict(settings)))
+
+		if not self.replies.poll(timeout):
+			raise EncoderPoolError("Encoder worker timed out after %ss" %timeout)
+
+		status, result = self.replies.recv()
+
+		if status != OK:
+			raise EncoderJobError(result)
+
+		return result
+
+	def stop(self, timeout=DEFAULT_PING_TIMEOUT):
+		try:
+			self.requests.send((STOP,))
+		except IOError:
+			pass
+
+		self.process.join(timeout)
+		if self.process.is_alive():
+			self.process.terminate()
+			self.process.join()
+
+		self.requests.close()
+		self.replies.close()
+
+
+class EncoderPool(object):
+	"""
+	Hands encode jobs to a fixed number of warm
+	worker processes. Workers are started ahead of
+	time by start() (or on first use otherwise),
+	health checked before each job and replaced in
+	the background if they die, time out or reach
+	maxJobs.
+
+	Usage mirrors the encoders themselves:
+		pool = EncoderPool(MP3Encoder)
+		pool.start()
+		mp3 = pool(filePath, headerSpec, bitRate=128)
+	"""
+
+	def __init__(self, encoderClass, size=DEFAULT_POOL_SIZE, maxJobs=DEFAULT_MAX_JOBS, timeout=DEFAULT_TIMEOUT):
+		if size < 1:
+			raise ValueError("Invalid pool size: %r. Expected >= 1" %size)
+
+		self.encoderClass = encoderClass
+		self.size = size
+		self.maxJobs = maxJobs
+		self.timeout = timeout
+		self.idle = Queue.Queue()
+		self.started = 0
+		self.closed = False
+		self.lock = threading.Lock()
+
+	def __call__(self, filePath, headerSpec, **settings):
+		worker = self.acquire()
+		try:
+			result = worker.encode(filePath, headerSpec, settings, self.timeout)
+		except EncoderJobError:
+			self.release(worker)
+			raise
+		except Exception:
+			# the worker's state is unknown - replace it
+			self.discard(worker)
+			raise
+
+		self.release(worker)
+		return result
+
+	def start(self):
+		"""
+		Starts workers until the pool is full, so
+		requests don't pay for process startup and
+		encoder setup. Call in the serving process
+		(after any fork) - workers can't be shared
+		between processes.
+		"""
+		workers = []
+		try:
+			while True:
+				with self.lock:
+					if self.closed or self.started >= self.size:
+						break
+					self.started += 1
+
+				workers.append(self.spawn())
+
+		finally:
+			# wait for the encoders to be built
+			for worker in workers:
+				worker.ping()
+				self.idle.put(worker)
+
+	def acquire(self):
+		"""
+		Returns a healthy idle worker, starting a
+		new one if the pool is not yet full.
+		"""
+		while True:
+			with self.lock:
+				spawn = self.idle.empty() and self.started < self.size
+				if spawn:
+					self.started += 1
+
+			if spawn:
+				return self.spawn()
+
+			# poll so that waiters notice slots freed by discarded workers
+			try:
+				worker = self.idle.get(timeout=1)
+			except Queue.Empty:
+				continue
+
+			if worker.ping():
+				return worker
+
+			self.discard(worker)
+
+	def release(self, worker):
+		if self.maxJobs is not None and worker.jobs >= self.maxJobs:
+			self.discard(worker)
+			return
+
+		self.idle.put(worker)
+
+	def discard(self, worker):
+		"""
+		Stops a worker and starts its replacement
+		in the background.
+		"""
+		with self.lock:
+			self.started -= 1
+
+		thread = threading.Thread(target=self.replace, args=(worker,))
+		thread.daemon = True
+		thread.start()
+
+	def replace(self, worker):
+		worker.stop()
+		self.start()
+
+	def spawn(self):
+		try:
+			return EncoderWorker(self.encoderClass)
+		except Exception:
+			with self.lock:
+				self.started -= 1
+			raise
+
+	def close(self):
+		"""
+		Stops all idle workers.
+		"""
+		with self.lock:
+			self.closed = True
+
+		while True:
+			try:
+				worker = self.idle.get_nowait()
+			except Queue.Empty:
+				break
+			with self.lock:
+				self.started -= 1
+			worker.stop()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+Streaming gain/normalisation stage applied before encoding.
+
+The first pass measures peak and RMS levels a chunk at a time, the
+second applies the gain chunk by chunk into a temporary WAV file which
+is then handed to the encoder. Only one chunk is held in memory at a
+time, and only the range selected by the header spec's start/end
+(frame offsets) is read.
+"""
+
+import math
+import numpy
+import os
+import tempfile
+import wave
+from HeaderSpec import HeaderSpec
+
+
+DEFAULT_CHUNK_FRAMES = 65536
+
+DEFAULT_LEVELS = {
+	"peak" : -1.0, # dBFS
+	"rms" : -20.0, # dBFS
+}
+
+# only linear PCM can be scaled directly - companded (a-law/mu-law)
+# and float audio are rejected
+SUPPORTED_ENCODING = HeaderSpec.PCM
+
+
+def dbToLinear(db):
+	return 10 ** (db / 20.0)
+
+
+def toSamples(data, width):
+	"""
+	Converts little-endian PCM bytes to floats
+	in the range [-1, 1).
+	"""
+	if width == 8:
+		return (numpy.frombuffer(data, numpy.uint8).astype(numpy.float32) - 128) / 128
+
+	if width == 16:
+		return numpy.frombuffer(data, "<i2").astype(numpy.float32) / 32768
+
+	if width == 24:
+		b = numpy.frombuffer(data, numpy.uint8).reshape(-1, 3).astype(numpy.int32)
+		v = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+		v = numpy.where(v >= 1 << 23, v - (1 << 24), v)
+		return v.astype(numpy.float32) / (1 << 23)
+
+	raise ValueError("Unsupported sample width: %r" %width)
+
+
+def fromSamples(samples, width):
+	"""
+	Converts floats back to little-endian PCM
+	bytes, clipping to full scale.
+	"""
+	scale = 1 << (width - 1)
+	v = numpy.clip(numpy.round(samples * scale), -scale, scale - 1).astype(numpy.int32)
+
+	if width == 8:
+		return (v + 128).astype(numpy.uint8).tostring()
+
+	if width == 16:
+		return v.astype("<i2").tostring()
+
+	if width == 24:
+		return numpy.column_stack((v & 0xFF, (v >> 8) & 0xFF, (v >> 16) & 0xFF)).astype(numpy.uint8).tostring()
+
+	raise ValueError("Unsupported sample width: %r" %width)
+
+
+def readChunks(filePath, info, chunkFrames=DEFAULT_CHUNK_FRAMES, startFrame=0, endFrame=None):
+	"""
+	Yields the audio data of a probed file (see
+	AudioProbe) between startFrame and endFrame
+	as arrays of float samples.
+	"""
+	bytesPerSample = info["width"] // 8
+	frameSize = bytesPerSample * info["channels"]
+
+	if endFrame is None or endFrame > info["frames"]:
+		endFrame = info["frames"]
+	remaining = max(0, endFrame - startFrame) * frameSize
+
+	with open(filePath, "rb") as fp:
+		fp.seek(info["dataOffset"] + startFrame * frameSize)
+
+		while remaining > 0:
+			data = fp.read(min(chunkFrames * frameSize, remaining))
+			if not data:
+				break
+			remaining -= len(data)
+			data = data[:len(data) - len(data) % bytesPerSample]
+			yield toSamples(data, info["width"])
+
+
+def measure(filePath, info, chunkFrames=DEFAULT_CHUNK_FRAMES, startFrame=0, endFrame=None):
+	"""
+	Returns the (peak, rms) level of the file (or
+	the given range) as fractions of full scale.
+	"""
+	peak = 0.0
+	sumOfSquares = 0.0
+	count = 0
+
+	for samples in readChunks(filePath, info, chunkFrames, startFrame, endFrame):
+		if not len(samples):
+			continue
+		peak = max(peak, float(numpy.abs(samples).max()))
+		sumOfSquares += float(numpy.dot(samples.astype(numpy.float64), samples))
+		count += len(samples)
+
+	rms = math.sqrt(sumOfSquares / count) if count else 0.0
+	return peak, rms
+
+
+def calculateGain(peak, rms, gain=None, normalize=None, level=None):
+	"""
+	Returns the linear gain for the given settings.
+	RMS normalisation is limited so that it never
+	pushes the peak past full scale.
+	"""
+	linear = 1.0
+
+	if normalize is not None:
+		if level is None:
+			level = DEFAULT_LEVELS[normalize]
+		target = dbToLinear(float(level))
+
+		if normalize == "peak" and peak > 0:
+			linear = target / peak
+
+		elif normalize == "rms" and rms > 0:
+			linear = target / rms
+			if peak > 0:
+				linear = min(linear, 1.0 / peak)
+
+	if gain is not None:
+		linear *= dbToLinear(float(gain))
+
+	return linear
+
+
+class GainStage(object):
+	"""
+	Context manager which writes a gain adjusted
+	copy of the requested range of audio to a
+	temporary WAV file and yields (filePath,
+	headerSpec) for the encoder. The file is
+	removed on exit.
+
+		with GainStage(filePath, headerSpec, info, normalize="peak") as (path, spec):
+			mp3 = encoder(path, spec)
+	"""
+
+	def __init__(self, filePath, headerSpec, info, chunkFrames=DEFAULT_CHUNK_FRAMES, **settings):
+		if info["encoding"] != SUPPORTED_ENCODING:
+			raise ValueError("Gain is not supported for %s audio" %info["encoding"])
+
+		self.filePath = filePath
+		self.headerSpec = HeaderSpec(headerSpec)
+		self.info = info
+		self.chunkFrames = chunkFrames
+		self.settings = settings
+		self.tempPath = None
+
+		# the clip requested by the header spec
+		self.startFrame = self.headerSpec.start or 0
+		self.endFrame = self.headerSpec.end
+
+	def __enter__(self):
+		if self.settings.get("normalize") is not None:
+			peak, rms = measure(self.filePath, self.info, self.chunkFrames, self.startFrame, self.endFrame)
+		else:
+			peak, rms = None, None
+
+		linear = calculateGain(peak, rms, **self.settings)
+
+		fd, self.tempPath = tempfile.mkstemp(suffix=".wav")
+		os.close(fd)
+
+		try:
+			w = wave.open(self.tempPath, "wb")
+			w.setnchannels(self.info["channels"])
+			w.setsampwidth(self.info["width"] // 8)
+			w.setframerate(self.info["rate"])
+
+			for samples in readChunks(self.filePath, self.info, self.chunkFrames, self.startFrame, self.endFrame):
+				w.writeframes(fromSamples(samples * linear, self.info["width"]))
+
+			w.close()
+
+		except Exception:
+			self.cleanup()
+			raise
+
+		# the temp file holds just the clip, so no offsets
+		return self.tempPath, HeaderSpec()
+
+	def __exit__(self, *excInfo):
+		self.cleanup()
+
+	def cleanup(self):
+		if self.tempPath is not None and os.path.exists(self.tempPath):
+			os.remove(self.tempPath)
+		self.tempPath = None
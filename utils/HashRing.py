@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+Consistent hash ring used to place cached artefacts on audio servers.
+"""
+
+import bisect
+import hashlib
+
+
+DEFAULT_VNODES = 100 # points per node on the ring
+
+
+class HashRing(object):
+	"""
+	Maps keys to an ordered list of distinct nodes.
+	Adding or removing a node only moves the keys
+	adjacent to its points on the ring.
+	"""
+
+	def __init__(self, nodes=(), vnodes=DEFAULT_VNODES):
+		self.vnodes = vnodes
+		self.hashes = []
+		self.points = {}
+
+		for node in nodes:
+			self.add(node)
+
+	@staticmethod
+	def hash(key):
+		return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+	def add(self, node):
+		for i in range(self.vnodes):
+			h = self.hash("%s#%d" %(node, i))
+			if h not in self.points:
+				bisect.insort(self.hashes, h)
+			self.points[h] = node
+
+	def remove(self, node):
+		for i in range(self.vnodes):
+			h = self.hash("%s#%d" %(node, i))
+			if self.points.get(h) == node:
+				del self.points[h]
+				self.hashes.remove(h)
+
+	def nodes(self, key, count=1):
+		"""
+		Returns up to count distinct nodes for the key,
+		in preference order.
+		"""
+		if not self.hashes:
+			return []
+
+		total = len(set(self.points.values()))
+		count = min(count, total)
+		start = bisect.bisect(self.hashes, self.hash(key))
+		found = []
+
+		for i in range(len(self.hashes)):
+			node = self.points[self.hashes[(start + i) % len(self.hashes)]]
+			if node not in found:
+				found.append(node)
+				if len(found) == count:
+					break
+
+		return found
+
+
+def parseNodes(s):
+	"""
+	Parses "name=url,name2=url2" into a dictionary
+	of node name -> base URL.
+	"""
+	nodes = {}
+
+	for pair in s.split(","):
+		pair = pair.strip()
+		if not pair:
+			continue
+		name, url = pair.split("=", 1)
+		nodes[name.strip()] = url.strip()
+
+	return nodes
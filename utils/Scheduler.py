@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+Schedules encoding/waveform jobs so that interactive requests aren't
+stuck behind bulk exports.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, BULK)
+
+DEFAULT_SLOTS = 4            # jobs running at once
+DEFAULT_BULK_LIMIT = 2       # bulk jobs running at once
+DEFAULT_BULK_PER_CLIENT = 1  # bulk jobs running at once per client
+DEFAULT_INTERACTIVE_SLO = 1.0 # seconds an interactive job may wait
+DEFAULT_MIN_BULK = 1         # bulk jobs still allowed while the SLO is at risk
+DEFAULT_RISK_WINDOW = 30     # seconds of interactive waits considered
+DEFAULT_HISTORY = 1000       # waits kept per class for reporting
+
+
+def percentile(values, p):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class Scheduler(object):
+	"""
+	Runs jobs in a limited number of slots. Interactive
+	jobs take any free slot. Bulk jobs only start when
+	no interactive job is waiting, within the overall
+	and per-client bulk limits, and are cut back to
+	minBulk while interactive waits in the last
+	riskWindow seconds exceed the SLO.
+
+	Running jobs are never interrupted; at risk bulk
+	work is deferred instead.
+
+	Jobs wait for admission in the caller's own thread
+	(or greenlet) on an event made by eventFactory,
+	before any blocking work is offloaded. The async
+	server swaps in gevent's Event so waiting jobs
+	don't tie up thread pool threads.
+	"""
+
+	def __init__(self, slots=DEFAULT_SLOTS, bulkLimit=DEFAULT_BULK_LIMIT, bulkPerClient=DEFAULT_BULK_PER_CLIENT,
+			interactiveSLO=DEFAULT_INTERACTIVE_SLO, minBulk=DEFAULT_MIN_BULK, riskWindow=DEFAULT_RISK_WINDOW, history=DEFAULT_HISTORY):
+		self.slots = slots
+		self.bulkLimit = bulkLimit
+		self.bulkPerClient = bulkPerClient
+		self.interactiveSLO = interactiveSLO
+		self.minBulk = minBulk
+		self.riskWindow = riskWindow
+
+		self.eventFactory = threading.Event
+		self.lock = threading.Lock() # never held while waiting
+		self.running = dict((priority, 0) for priority in PRIORITIES)
+		self.waiting = dict((priority, 0) for priority in PRIORITIES)
+		self.bulkByClient = {}
+
+		# FIFO of waiting (client, queued, event) per class
+		self.queues = dict((priority, deque()) for priority in PRIORITIES)
+
+		# (start time, wait) per class
+		self.waits = dict((priority, deque(maxlen=history)) for priority in PRIORITIES)
+
+	def __call__(self, priority, client, func, *args, **kwArgs):
+		"""
+		Waits for a slot then runs func.
+		"""
+		with self.slot(priority, client):
+			return func(*args, **kwArgs)
+
+	@contextmanager
+	def slot(self, priority, client):
+		"""
+		Holds a slot for the duration of the block.
+		"""
+		self.acquire(priority, client)
+		try:
+			yield
+		finally:
+			self.release(priority, client)
+
+	def acquire(self, priority, client):
+		"""
+		Waits until the job is admitted.
+		"""
+		if priority not in PRIORITIES:
+			raise ValueError("Invalid priority: %r. Expected one of: %s" %(priority, ", ".join(PRIORITIES)))
+
+		queued = time.time()
+
+		with self.lock:
+			# jobs of the same class are admitted in order
+			if not self.queues[priority] and self.canStart(priority, client):
+				self.start(priority, client, queued)
+				return
+
+			waiter = (client, queued, self.eventFactory())
+			self.queues[priority].append(waiter)
+			self.waiting[priority] += 1
+
+		# start() is called on our behalf by dispatch()
+		try:
+			waiter[2].wait()
+		except BaseException:
+			# killed while waiting - give up our place or the slot
+			with self.lock:
+				if waiter in self.queues[priority]:
+					self.queues[priority].remove(waiter)
+					self.waiting[priority] -= 1
+					waiter = None
+			if waiter is not None:
+				self.release(priority, client)
+			raise
+
+	def release(self, priority, client):
+		with self.lock:
+			self.running[priority] -= 1
+			if priority == BULK:
+				self.bulkByClient[client] -= 1
+				if not self.bulkByClient[client]:
+					del self.bulkByClient[client]
+			self.dispatch()
+
+	def start(self, priority, client, queued):
+		self.running[priority] += 1
+		if priority == BULK:
+			self.bulkByClient[client] = self.bulkByClient.get(client, 0) + 1
+
+		now = time.time()
+		self.waits[priority].append((now, now - queued))
+
+	def dispatch(self):
+		"""
+		Admits waiting jobs into free slots, interactive
+		first. Must be called holding the lock.
+		"""
+		for priority in PRIORITIES:
+			queue = self.queues[priority]
+			for waiter in list(queue):
+				client, queued, event = waiter
+				if not self.canStart(priority, client):
+					# interactive jobs only wait for a slot, so
+					# none of the later ones can start either
+					if priority == INTERACTIVE:
+						break
+					continue
+				queue.remove(waiter)
+				self.waiting[priority] -= 1
+				self.start(priority, client, queued)
+				event.set()
+
+	def canStart(self, priority, client):
+		if sum(self.running.values()) >= self.slots:
+			return False
+
+		if priority == INTERACTIVE:
+			return True
+
+		if self.waiting[INTERACTIVE]:
+			return False
+
+		if self.running[BULK] >= self.bulkLimit:
+			return False
+
+		if self.bulkByClient.get(client, 0) >= self.bulkPerClient:
+			return False
+
+		if self.isAtRisk() and self.running[BULK] >= self.minBulk:
+			return False
+
+		return True
+
+	def isAtRisk(self):
+		"""
+		True if an interactive job recently waited
+		longer than the SLO.
+		"""
+		since = time.time() - self.riskWindow
+		return any(wait > self.interactiveSLO for finished, wait in self.waits[INTERACTIVE] if finished >= since)
+
+	@property
+	def stats(self):
+		"""
+		Queue lengths and wait times per class.
+		"""
+		with self.lock:
+			stats = {"atRisk" : self.isAtRisk()}
+
+			for priority in PRIORITIES:
+				waits = [wait for finished, wait in self.waits[priority]]
+				stats[priority] = {
+					"waiting" : self.waiting[priority],
+					"running" : self.running[priority],
+					"count" : len(waits),
+					"mean" : sum(waits) / len(waits) if waits else None,
+					"p50" : percentile(waits, 50),
+					"p95" : percentile(waits, 95),
+					"max" : max(waits) if waits else None,
+				}
+
+			return stats
@@ -20,7 +20,6 @@ import struct
 import wave
 from array import array
 from cStringIO import StringIO
-from scikits import audiolab
 from HeaderSpec import HeaderSpec
 
 
@@ -1,4 +1,64 @@
+import sys
+from types import ModuleType
+
+from ArtefactCache import ArtefactCache
+from AudioProbe import AudioProbe, ProbeError
 from AudioServerRequest import AudioServerRequest
-from AudioServerSettings import MP3Settings, OggSettings, WaveformSettings
+from AudioServerSettings import MP3Settings, OggSettings, WaveformSettings, InfoSettings
+from EncoderPool import EncoderPool, EncoderPoolError
+from HashRing import HashRing, parseNodes
 from HeaderSpec import HeaderSpec
-from WaveformGenerator import WaveformGenerator
+from Scheduler import Scheduler, INTERACTIVE, BULK
+
+# attribute -> submodule, for exports which pull in heavy
+# dependencies (PIL, NumPy) and are only imported on first use
+LAZY_ATTRIBUTES = {
+	"GainStage" : "GainStage",
+	"WaveformGenerator" : "WaveformGenerator",
+}
+
+
+class LazyModule(ModuleType):
+	"""
+	Stands in for this package in sys.modules and
+	imports the lazy attributes when first accessed.
+	"""
+
+	def __getattr__(self, name):
+		try:
+			moduleName = LAZY_ATTRIBUTES[name]
+		except KeyError:
+			raise AttributeError("'module' object has no attribute %r" %name)
+
+		module = __import__("%s.%s" %(self.__name__, moduleName), fromlist=[name])
+
+		# importing the submodule binds its name on the package,
+		# so set every export from it (which may share that name)
+		for attr, attrModuleName in LAZY_ATTRIBUTES.items():
+			if attrModuleName == moduleName:
+				setattr(self, attr, getattr(module, attr))
+
+		return getattr(module, name)
+
+	def __dir__(self):
+		return sorted(set(self.__dict__) | set(LAZY_ATTRIBUTES))
+
+
+def preload():
+	"""
+	Imports all lazy attributes. Call before forking
+	worker processes so they share the imported
+	modules copy-on-write instead of each paying the
+	import cost.
+	"""
+	package = sys.modules[__name__]
+	for name in LAZY_ATTRIBUTES:
+		getattr(package, name)
+
+
+lazyModule = LazyModule(__name__)
+lazyModule.__dict__.update(sys.modules[__name__].__dict__)
+# keep the original module alive - Python 2 clears the globals
+# of modules that are garbage collected
+lazyModule.originalModule = sys.modules[__name__]
+sys.modules[__name__] = lazyModule